@@ -1,3 +1,3 @@
-from src.base import Template, Collector
+from src.base import Template, Collector, Environment
 
 __version__ = '0.1'
\ No newline at end of file
@@ -1,22 +1,17 @@
 """Simple template engine."""
 import re
-import operator
+import os
+import gc
+import sys
 import ast
+import time
+import fnmatch
+import operator
 from src.exceptions import TemplateError
 from src.exceptions import TemplateContextError, TemplateSyntaxError
 from src.exceptions import TemplateInheritanceError, TemplateLoopInheritanceError
 
 
-def flatten(input_list):
-    output_list = []
-    for element in input_list:
-        if type(element) == list:
-            output_list.extend(flatten(element))
-        else:
-            output_list.append(element)
-    return output_list
-
-
 PAGE_TOKEN_START = '{!'
 PAGE_TOKEN_END = '!}'
 PAGE_REGEX = re.compile(r"(%s.*?%s)" % (
@@ -90,8 +85,9 @@ def resolve(name, context):
 class Fragment:
     """Fragment of template which used for definition of tokens."""
 
-    def __init__(self, raw_text):
+    def __init__(self, raw_text, position=0):
         self.raw = raw_text
+        self.position = position
         self.clean = self.clean_fragment()
 
     def clean_fragment(self):
@@ -194,14 +190,14 @@ class If(Node):
         self.lhs = eval_expression(bits[0])
         if len(bits) == 3:
             self.op = bits[1]
+            if self.op not in OPERATOR_TABLE:
+                raise TemplateSyntaxError(fragment, message='Unknown operator {0}'.format(self.op))
             self.rhs = eval_expression(bits[2])
 
     def render(self, context):
         lhs = self.resolve_side(self.lhs, context)
         if hasattr(self, 'op'):
-            op = OPERATOR_TABLE.get(self.op)
-            if op is None:
-                raise TemplateSyntaxError(self.op)
+            op = OPERATOR_TABLE[self.op]
             rhs = self.resolve_side(self.rhs, context)
             exec_if_branch = op(lhs, rhs)
         else:
@@ -246,31 +242,60 @@ class Text(Node):
 class Compiler:
     """Find, process and compile all instructions in template."""
 
-    def __init__(self, template_string):
+    def __init__(self, template_string, name=None):
         self.template_string = template_string
+        self.name = name
 
     def each_fragment(self):
-        for fragment in TOKEN_REGEX.split(self.template_string):
-            if fragment:
-                yield Fragment(fragment)
+        """Split template into fragments, keeping their offsets."""
+        source = self.template_string
+        position = 0
+        for match in TOKEN_REGEX.finditer(source):
+            start = match.start()
+            if start > position:
+                yield Fragment(source[position:start], position)
+            yield Fragment(match.group(), start)
+            position = match.end()
+        if position < len(source):
+            yield Fragment(source[position:], position)
+
+    def error(self, exc, fragment):
+        """Attach location of fragment to the error."""
+        return exc.locate(self.template_string, fragment.position, self.name)
 
     def compile(self):
+        """Build tree of nodes, checking balance of blocks on the way."""
         root = Root()
         scope_stack = [root]
+        open_fragments = []
         for fragment in self.each_fragment():
-            if not scope_stack:
-                raise TemplateError('nesting issues')
             parent_scope = scope_stack[-1]
             if fragment.type == CLOSE_BLOCK_FRAGMENT:
+                if not open_fragments:
+                    raise self.error(TemplateSyntaxError(
+                        fragment.raw,
+                        message='Unexpected {0}'.format(fragment.raw)
+                    ), fragment)
                 parent_scope.exit_scope()
                 scope_stack.pop()
+                open_fragments.pop()
                 continue
-            new_node = self.create_node(fragment)
+            try:
+                new_node = self.create_node(fragment)
+            except TemplateError as exc:
+                raise self.error(exc, fragment)
             if new_node:
                 parent_scope.children.append(new_node)
                 if new_node.creates_scope:
                     scope_stack.append(new_node)
+                    open_fragments.append(fragment)
                     new_node.enter_scope()
+        if open_fragments:
+            fragment = open_fragments[-1]
+            raise self.error(TemplateSyntaxError(
+                fragment.raw,
+                message='Unclosed block {0}'.format(fragment.raw)
+            ), fragment)
         return root
 
     def create_node(self, fragment):
@@ -280,7 +305,8 @@ class Compiler:
         elif fragment.type == VARIABLE_FRAGMENT:
             node_class = Variable
         elif fragment.type == OPEN_BLOCK_FRAGMENT:
-            cmd = fragment.clean.split()[0]
+            bits = fragment.clean.split()
+            cmd = bits[0] if bits else None
             if cmd == 'array':
                 node_class = Array
             elif cmd == 'if':
@@ -288,115 +314,361 @@ class Compiler:
             elif cmd == 'else':
                 node_class = Else
         if node_class is None:
-            raise TemplateSyntaxError(fragment)
+            raise TemplateSyntaxError(fragment.raw)
         return node_class(fragment.clean)
 
 
 class Template:
 
-    def __init__(self, contents):
+    def __init__(self, contents, name=None):
         self.contents = contents
-        self.root = Compiler(contents).compile()
+        self.name = name
+        self.root = Compiler(contents, name).compile()
 
     def render(self, **kwargs):
         return self.root.render(kwargs)
 
 
+class SourceText:
+    """Text assembled from pieces of template files.
+
+    Every piece remembers the file it was taken from and its offset
+    there, so positions in assembled page can be mapped back.
+    """
+
+    def __init__(self, pieces=()):
+        self.pieces = [piece for piece in pieces if piece[0]]
+
+    @classmethod
+    def join(cls, parts):
+        return cls([piece for part in parts for piece in part.pieces])
+
+    def __str__(self):
+        return ''.join(piece[0] for piece in self.pieces)
+
+    def __len__(self):
+        return sum(len(piece[0]) for piece in self.pieces)
+
+    def slice(self, start, end):
+        return self.slices([(start, end)])[0]
+
+    def slices(self, bounds):
+        """Cut text by ordered, non-overlapping bounds in one pass."""
+        parts = []
+        index = 0
+        position = 0
+        for start, end in bounds:
+            while index < len(self.pieces) and position + len(self.pieces[index][0]) <= start:
+                position += len(self.pieces[index][0])
+                index += 1
+            pieces = []
+            i, piece_position = index, position
+            while i < len(self.pieces) and piece_position < end:
+                text, name, offset = self.pieces[i]
+                left = max(start - piece_position, 0)
+                right = min(end - piece_position, len(text))
+                if left < right:
+                    pieces.append((text[left:right], name, offset + left))
+                piece_position += len(text)
+                i += 1
+            parts.append(SourceText(pieces))
+        return parts
+
+    def split(self, regex):
+        """Same as non-empty parts of regex.split of the text."""
+        text = str(self)
+        bounds = []
+        position = 0
+        for match in regex.finditer(text):
+            if match.start() > position:
+                bounds.append((position, match.start()))
+            bounds.append((match.start(), match.end()))
+            position = match.end()
+        if position < len(text):
+            bounds.append((position, len(text)))
+        return self.slices(bounds)
+
+    def strip(self):
+        text = str(self)
+        start = len(text) - len(text.lstrip())
+        return self.slice(start, max(start, len(text.rstrip())))
+
+    def locate(self, position):
+        """File name and offset in it for position in text."""
+        name, offset = None, None
+        for text, name, offset in self.pieces:
+            if position < len(text):
+                return name, offset + position
+            position -= len(text)
+            offset += len(text)
+        return name, offset
+
+
 class Collector:
-    """Collect all nested templates, then transmit them to Template."""
+    """Collect all nested templates, then transmit them to Template.
+
+    Pages are assembled from plain strings. With tracking, SourceText is
+    used instead, so errors can point to the file they come from.
+    """
 
-    def __init__(self, absolute_path, pagename):
+    def __init__(self, absolute_path, pagename, tracking=False):
         self.path = absolute_path
         self.pagename = pagename
-        self.collected_page = [pagename]
-        with open(self.path + self.pagename, 'r') as file:
-            self.file = str(file.read())
+        self.name = pagename.lstrip('/')
+        self.tracking = tracking
+        self.collected_page = [self.name]
+        self.sources = {}
+        self.file = self.read_source(self.name, self.path + self.pagename)
 
     def __str__(self):
-        return self.file
+        return str(self.file)
 
-    def assemble_page(self, **kwargs):
+    def compile(self):
+        """Resolve inheritance and includes, then compile the page.
+
+        If it fails, the page is assembled once more with tracking to
+        find the file and line of the error.
+        """
+        try:
+            return self.compile_page()
+        except TemplateError:
+            if self.tracking:
+                raise
+            located = self.locate_error()
+            if located is None:
+                raise
+        raise located
+
+    def compile_page(self):
         self.prepare_page()
         self.file = self.prepare_include_tags()
-        rendered = Template(str(self.file)).render(**kwargs)
+        try:
+            return Template(str(self.file), self.name)
+        except TemplateError as exc:
+            if exc.offset is None or not self.tracking:
+                raise
+            raise self.error(exc, self.file.slice(exc.offset, exc.offset + 1))
+
+    def locate_error(self):
+        try:
+            Collector(self.path, self.pagename, tracking=True).compile_page()
+        except TemplateError as exc:
+            return exc
+
+    def assemble_page(self, **kwargs):
+        rendered = self.compile().render(**kwargs)
         return rendered
 
-    def prepare_include_tags(self, text=None):
-        if text:
-            include_tags = [x for x in INCLUDE_TAGS_REGEX.split(text) if x]
+    def error(self, exc, text):
+        """Point the error to the file and offset text was taken from."""
+        if not self.tracking:
+            exc.name = self.name
+            return exc
+        name, offset = text.locate(0)
+        if name is None:
+            exc.name = self.name
+            return exc
+        exc.name = name
+        exc.source = self.sources[name]
+        exc.offset = offset
+        return exc
+
+    def split(self, text, regex):
+        if self.tracking:
+            return text.split(regex)
+        return [x for x in regex.split(text) if x]
+
+    def join(self, parts):
+        if self.tracking:
+            return SourceText.join(parts)
+        return ''.join(parts)
+
+    def prepare_include_tags(self, text=None, included=()):
+        if text is not None:
+            include_tags = self.split(text, INCLUDE_TAGS_REGEX)
         else:
-            include_tags = [x for x in INCLUDE_TAGS_REGEX.split(self.file) if x]
-        if len(include_tags) == 1 and text is None:
-            return ''.join(flatten(include_tags))
-        elif len(include_tags) == 1:
-            return include_tags
+            include_tags = self.split(self.file, INCLUDE_TAGS_REGEX)
+        if len(include_tags) == 1:
+            return self.join(include_tags)
         tags = []
         for i in range(len(include_tags)):
-            if include_tags[i][:2] == "{#" and include_tags[i][-2:] == "#}":
-                cur = include_tags[i][2:-2].strip()
+            tag = str(include_tags[i])
+            if tag[:2] == "{#" and tag[-2:] == "#}":
+                cur = tag[2:-2].strip()
                 tags.append([cur, i])
         for i in range(len(tags)):
+            if tags[i][0] in included:
+                raise self.error(TemplateLoopInheritanceError(tags[i][0]), include_tags[tags[i][1]])
             text = self.find_parent_data(tags[i][0])
-            res = self.prepare_include_tags(text)
+            res = self.prepare_include_tags(text, included + (tags[i][0],))
             include_tags[tags[i][1]] = res
-        return ''.join(flatten(include_tags))
+        return self.join(include_tags)
 
     def prepare_page(self, previous_blocks=None):
         if previous_blocks is not None:
             self.file = self.find_blocks_for_substition(previous_blocks)
-        components = [x.strip() for x in PAGE_REGEX.split(str(self.file)) if x]
+        components = [x.strip() for x in self.split(self.file, PAGE_REGEX)]
         if len(components) == 1:
             return
         elif len(components) == 2:
-            parent_address = components[0][2:-2].strip().strip('"').strip("'")
+            parent_address = str(components[0])[2:-2].strip().strip('"').strip("'")
             if parent_address not in self.collected_page:
                 self.collected_page.append(parent_address)
             else:
-                raise TemplateLoopInheritanceError
+                raise self.error(TemplateLoopInheritanceError(parent_address), components[0])
             blocks = self.find_blocks(components[1])
             self.file = self.find_parent_data(parent_address)
             self.prepare_page(blocks)
+        elif not components:
+            raise TemplateInheritanceError('page is empty', name=self.name)
         else:
-            raise TemplateInheritanceError
+            raise self.error(TemplateInheritanceError(
+                'parent tag must come first and only once'
+            ), components[1])
 
     def find_blocks(self, raw_blocks):
-        blocks = [x for x in PAGE_BLOCKS_REGEX.split(raw_blocks) if x]
+        blocks = self.split(raw_blocks, PAGE_BLOCKS_REGEX)
         stack = []
         dic = {}
         for i in range(len(blocks)):
-            if blocks[i][:2] == '{?' and 'endblock' not in blocks[i]:
-                cur = blocks[i][2:-2].strip()
+            block = str(blocks[i])
+            if block[:2] == '{?' and 'endblock' not in block:
+                cur = block[2:-2].strip()
                 stack.append([cur, i])
-            elif blocks[i][:2] == '{?' and 'endblock' in blocks[i]:
+            elif block[:2] == '{?' and 'endblock' in block:
                 if len(stack) == 0:
-                    raise TemplateSyntaxError
+                    raise self.error(TemplateSyntaxError(block), blocks[i])
                 start = stack.pop()
                 dic[start[0]] = [blocks[x] for x in range(start[1] + 1, i)]
         return dic
 
     def find_blocks_for_substition(self, subs):
-        components = [x for x in PAGE_BLOCKS_REGEX.split(str(self.file)) if x]
+        components = self.split(self.file, PAGE_BLOCKS_REGEX)
         stack = []
         dic = {}
         for i in range(len(components)):
-            if components[i][:2] == '{?' and 'endblock' not in components[i]:
-                cur = components[i][2:-2].strip()
+            component = str(components[i])
+            if component[:2] == '{?' and 'endblock' not in component:
+                cur = component[2:-2].strip()
                 stack.append([cur, i])
-            elif components[i][:2] == '{?' and 'endblock' in components[i]:
+            elif component[:2] == '{?' and 'endblock' in component:
                 if len(stack) == 0:
-                    raise TemplateSyntaxError
+                    raise self.error(TemplateSyntaxError(component), components[i])
                 start = stack.pop()
                 dic[start[0]] = list(range(start[1], i + 1))
         for i in dic.keys():
             if i in subs.keys():
                 for j in dic[i]:
-                    components[j] = ''
-                components[dic[i][0]] = "".join(subs[i])
-        return "".join(components)
+                    components[j] = self.join([])
+                components[dic[i][0]] = self.join(subs[i])
+        return self.join(components)
 
     def find_parent_data(self, parent_name):
-        with open(self.path + '/' + parent_name, 'r') as file:
-            return str(file.read())
+        return self.read_source(parent_name, self.path + '/' + parent_name)
+
+    def read_source(self, name, filename):
+        with open(filename, 'r') as file:
+            text = str(file.read())
+        if not self.tracking:
+            return text
+        self.sources[name] = text
+        return SourceText([(text, name, 0)])
+
+
+def sizeof(obj, seen=None):
+    """Memory used by object and everything it refers to."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(sizeof(key, seen) + sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(sizeof(item, seen) for item in obj)
+    elif hasattr(obj, '__dict__'):
+        size += sizeof(obj.__dict__, seen)
+    return size
+
+
+class PreloadReport:
+    """Result of Environment.preload."""
+
+    def __init__(self):
+        self.loaded = []
+        self.errors = {}
+        self.seconds = 0.0
+        self.memory = 0
+
+    def __str__(self):
+        report = 'Loaded {0} templates in {1:.3f}s, {2:.1f} KiB'.format(
+            len(self.loaded), self.seconds, self.memory / 1024
+        )
+        if self.errors:
+            report += ', {0} failed'.format(len(self.errors))
+        return report
+
+
+class Environment:
+    """Compiled pages of one templates directory."""
+
+    def __init__(self, absolute_path):
+        self.path = absolute_path
+        self.templates = {}
+
+    def get_template(self, pagename):
+        template = self.templates.get(pagename)
+        if template is None:
+            template = Collector(self.path, '/' + pagename).compile()
+            self.templates[pagename] = template
+        return template
+
+    def render(self, pagename, **kwargs):
+        return self.get_template(pagename).render(**kwargs)
+
+    def list_templates(self, pattern='*'):
+        """Names of pages in directory, relative to it, matching pattern."""
+        for root, dirs, files in os.walk(self.path):
+            dirs[:] = sorted(
+                directory for directory in dirs
+                if not directory.startswith('.') and directory != '__pycache__'
+            )
+            for filename in sorted(files):
+                name = os.path.relpath(os.path.join(root, filename), self.path)
+                name = name.replace(os.sep, '/')
+                if fnmatch.fnmatch(name, pattern):
+                    yield name
+
+    def preload(self, templates='*.html', freeze=True):
+        """Compile pages before forking workers.
+
+        templates is a glob pattern or a list of page names. Memory in
+        the report is the size of compiled pages, measured after timing
+        so it doesn't add to it. With freeze, compiled trees are moved to
+        the permanent generation of gc, so collections in children don't
+        touch their copy-on-write pages. To keep these pages free of holes,
+        call gc.disable() before preload and gc.enable() in the children.
+        """
+        if isinstance(templates, str):
+            templates = self.list_templates(templates)
+        report = PreloadReport()
+        started = time.perf_counter()
+        for pagename in templates:
+            try:
+                self.get_template(pagename)
+            except (TemplateError, OSError, ValueError) as exc:
+                report.errors[pagename] = exc
+            else:
+                report.loaded.append(pagename)
+        report.seconds = time.perf_counter() - started
+        seen = set()
+        report.memory = sum(
+            sizeof(self.templates[pagename], seen) for pagename in report.loaded
+        )
+        if freeze and hasattr(gc, 'freeze'):
+            gc.freeze()
+        return report
 
 
 if __name__ == "__main__":
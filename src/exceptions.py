@@ -1,57 +1,109 @@
 """Exceptions of 'simple-template-engine'."""
-import logging
+import re
 
 
 class TemplateError(Exception):
-    """Main template error."""
+    """Main template error.
+
+    Keeps template name, source and offset of the failure. Line, column
+    and the annotated snippet are computed only when the error is formatted.
+    """
+
+    def __init__(self, message=None, name=None, source=None, offset=None):
+        super().__init__(message)
+        self.message = message
+        self.name = name
+        self.source = source
+        self.offset = offset
+
+    def locate(self, source, offset, name=None):
+        """Attach position of the error, if it is not known yet."""
+        if self.source is None:
+            self.source = source
+            self.offset = offset
+        if self.name is None:
+            self.name = name
+        return self
+
+    @property
+    def lineno(self):
+        if self.source is None or self.offset is None:
+            return None
+        return self.source.count('\n', 0, self.offset) + 1
+
+    @property
+    def colno(self):
+        if self.source is None or self.offset is None:
+            return None
+        return self.offset - self.source.rfind('\n', 0, self.offset)
+
+    def describe(self):
+        return self.message or 'Template error'
+
+    def snippet(self):
+        """Line of template with caret under the error position."""
+        if self.lineno is None:
+            return ''
+        lines = self.source.split('\n')
+        line = lines[self.lineno - 1]
+        padding = re.sub(r'\S', ' ', line[:self.colno - 1])
+        return '    {0}\n    {1}^'.format(line, padding)
 
-    def __init__(self):
-        logging.warning('Template error!')
+    def __str__(self):
+        description = self.describe()
+        location = []
+        if self.name is not None:
+            location.append(str(self.name))
+        if self.lineno is not None:
+            location.append('line {0}, column {1}'.format(self.lineno, self.colno))
+        if not location:
+            return description
+        return '{0} ({1})\n{2}'.format(description, ', '.join(location), self.snippet()).rstrip()
 
 
 class TemplateContextError(TemplateError):
     """Wrong context, not given context instructions."""
 
-    def __init__(self, context):
-        super().__init__()
+    def __init__(self, context, **kwargs):
+        super().__init__(**kwargs)
         self.context = context
-        logging.warning('Template context error!')
+        self.args = (context,)
 
-    def __str__(self):
-        return 'Cannot resolve {0}'.format(self.context_var)
+    def describe(self):
+        return self.message or 'Cannot resolve {0}'.format(self.context)
 
 
 class TemplateSyntaxError(TemplateError):
     """Wrong syntax."""
 
-    def __init(self, syntax_error):
-        super().__init__()
+    def __init__(self, syntax_error=None, **kwargs):
+        super().__init__(**kwargs)
         self.syntax_error = syntax_error
-        logging.warning('Template syntax error!')
+        self.args = (syntax_error,)
 
-    def __str__(self):
-        return 'Invalid syntax {0}'.format(self.syntax_error)
+    def describe(self):
+        return self.message or 'Invalid syntax {0}'.format(self.syntax_error)
 
 
 class TemplateInheritanceError(TemplateError):
     """Multiple inheritance."""
 
-    def __init(self, inheritance_error):
-        super().__init__()
+    def __init__(self, inheritance_error=None, **kwargs):
+        super().__init__(**kwargs)
         self.inheritance_error = inheritance_error
-        logging.warning('Template inheritance error!')
+        self.args = (inheritance_error,)
 
-    def __str__(self):
-        return 'Invalid inheritance {0}'.format(self.inheritance_error)
+    def describe(self):
+        return self.message or 'Invalid inheritance {0}'.format(self.inheritance_error)
 
 
 class TemplateLoopInheritanceError(TemplateError):
     """Inheritance loop."""
 
-    def __init(self, loop_error):
-        super().__init__()
+    def __init__(self, loop_error=None, **kwargs):
+        super().__init__(**kwargs)
         self.loop_error = loop_error
-        logging.warning('Template loop error!')
+        self.args = (loop_error,)
 
-    def __str__(self):
-        return 'Invalid inheritance {0}'.format(self.loop_error)
+    def describe(self):
+        return self.message or 'Inheritance loop {0}'.format(self.loop_error)
@@ -1,6 +1,13 @@
+import gc
+import codecs
+import locale
+import shutil
+import timeit
+import tempfile
 import unittest
-from src.base import Template, Collector
+from src.base import Template, Collector, Environment
 from src.exceptions import TemplateInheritanceError, TemplateLoopInheritanceError
+from src.exceptions import TemplateSyntaxError, TemplateContextError
 import os.path
 
 path_for_testing_dir = os.path.abspath(os.path.dirname(__file__))
@@ -178,12 +185,164 @@ My amazing blog2 </title>
 </html>"""
         self.assertEqual(str(test_file), test_value)
 
+    def assembly_time(self, count):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'parent.html'), 'w') as file:
+            file.write(''.join('<div>{? b%d ?}{? endblock ?}</div>\n' % i for i in range(count)))
+        with open(os.path.join(directory, 'part.html'), 'w') as file:
+            file.write('<p>part</p>')
+        with open(os.path.join(directory, 'child.html'), 'w') as file:
+            file.write('{! "parent.html" !}\n' + ''.join(
+                '{? b%d ?}<span>{# part.html #}</span>{? endblock ?}\n' % i for i in range(count)
+            ))
+        return min(timeit.repeat(
+            lambda: Collector(directory, '/child.html').assemble_page(), number=1, repeat=5
+        ))
+
+    def test_assembly_is_linear_in_blocks(self):
+        ratio = self.assembly_time(400) / self.assembly_time(100)
+        self.assertLess(ratio, 8)
+
+
+class ErrorTests(unittest.TestCase):
+
+    def test_unclosed_block(self):
+        with self.assertRaises(TemplateSyntaxError) as cm:
+            Template('<div>\n  {% if num > 1 %}<p>x</p>\n</div>', 'page.html')
+        error = cm.exception
+        self.assertEqual(error.name, 'page.html')
+        self.assertEqual((error.lineno, error.colno), (2, 3))
+        self.assertEqual(str(error), """Unclosed block {% if num > 1 %} (page.html, line 2, column 3)
+      {% if num > 1 %}<p>x</p>
+      ^""")
+
+    def test_unexpected_end(self):
+        with self.assertRaises(TemplateSyntaxError) as cm:
+            Template('<div>{{name}}</div>{% end %}')
+        self.assertEqual((cm.exception.lineno, cm.exception.colno), (1, 20))
+
+    def test_unknown_block(self):
+        with self.assertRaises(TemplateSyntaxError) as cm:
+            Template('<div>\n{% while x %}{% end %}</div>')
+        self.assertEqual((cm.exception.lineno, cm.exception.colno), (2, 1))
+        self.assertTrue(str(cm.exception).startswith('Invalid syntax {% while x %}'))
+
+    def test_unknown_operator(self):
+        with self.assertRaises(TemplateSyntaxError) as cm:
+            Template('{% if a <> 1 %}{% end %}')
+        self.assertEqual(cm.exception.colno, 1)
+
+    def test_error_without_location(self):
+        self.assertEqual(str(TemplateContextError('name')), 'Cannot resolve name')
+
+    def test_caret_under_tabs(self):
+        with self.assertRaises(TemplateSyntaxError) as cm:
+            Template('a\n\t {% if %}{% end %}')
+        self.assertEqual(cm.exception.snippet(), '    \t {% if %}{% end %}\n    \t ^')
+
+    def test_detail_in_args(self):
+        self.assertEqual(TemplateSyntaxError('{% x %}').args, ('{% x %}',))
+
+    def test_error_in_child_page(self):
+        with self.assertRaises(TemplateSyntaxError) as cm:
+            Collector(path_for_testing_dir, "/compile_errors/child.html").compile()
+        error = cm.exception
+        self.assertEqual(error.name, 'compile_errors/child.html')
+        self.assertEqual((error.lineno, error.colno), (5, 5))
+        self.assertIn('(compile_errors/child.html, line 5, column 5)\n        {% if x %}', str(error))
+
+    def test_error_in_included_page(self):
+        with self.assertRaises(TemplateSyntaxError) as cm:
+            Collector(path_for_testing_dir, "/compile_errors/index.html").compile()
+        error = cm.exception
+        self.assertEqual(error.name, 'compile_errors/footer.html')
+        self.assertEqual((error.lineno, error.colno), (2, 2))
+
+    def test_empty_page(self):
+        with self.assertRaises(TemplateInheritanceError) as cm:
+            Collector(path_for_testing_dir, "/multiple_inheritance/mult_inher.html").compile()
+        self.assertEqual(str(cm.exception), 'Invalid inheritance page is empty (multiple_inheritance/mult_inher.html)')
+
+    def test_loop_inheritance_names_page(self):
+        with self.assertRaises(TemplateLoopInheritanceError) as cm:
+            Collector(path_for_testing_dir, "/loop/self_loop.html").assemble_page()
+        self.assertEqual(cm.exception.loop_error, 'loop/self_loop.html')
+        self.assertEqual((cm.exception.name, cm.exception.lineno), ('loop/self_loop.html', 1))
+
+
+class EnvironmentTests(unittest.TestCase):
+
+    def test_preload_list(self):
+        env = Environment(path_for_testing_dir)
+        report = env.preload(['single_page.html', 'basic_include/index.html'], freeze=False)
+        self.assertEqual(report.loaded, ['single_page.html', 'basic_include/index.html'])
+        self.assertEqual(report.errors, {})
+        self.assertEqual(env.render('single_page.html', name='alex'), '<div>alex</div>')
+
+    def test_preload_glob(self):
+        env = Environment(path_for_testing_dir)
+        report = env.preload('basic_include/*.html', freeze=False)
+        self.assertEqual(report.loaded, ['basic_include/footer.html', 'basic_include/header.html', 'basic_include/index.html'])
+        self.assertTrue(str(report).startswith('Loaded 3 templates in '))
+
+    def test_preload_collects_errors(self):
+        env = Environment(path_for_testing_dir)
+        report = env.preload('loop/*.html', freeze=False)
+        self.assertEqual(report.loaded, [])
+        self.assertIsInstance(report.errors['loop/self_loop.html'], TemplateLoopInheritanceError)
+
+    def test_preload_records_error_location(self):
+        env = Environment(path_for_testing_dir)
+        report = env.preload(['compile_errors/child.html'], freeze=False)
+        error = report.errors['compile_errors/child.html']
+        self.assertEqual((error.name, error.lineno, error.colno), ('compile_errors/child.html', 5, 5))
+
+    def test_preload_include_loop(self):
+        env = Environment(path_for_testing_dir)
+        report = env.preload(['include_loop/first.html'], freeze=False)
+        error = report.errors['include_loop/first.html']
+        self.assertIsInstance(error, TemplateLoopInheritanceError)
+        self.assertEqual((error.name, error.lineno), ('include_loop/first.html', 2))
+
+    @unittest.skipUnless(codecs.lookup(locale.getpreferredencoding(False)).name == 'utf-8',
+                         'templates are read with locale encoding')
+    def test_preload_records_decode_errors(self):
+        env = Environment(path_for_testing_dir)
+        report = env.preload('not_utf8/*.html', freeze=False)
+        self.assertEqual(report.loaded, ['not_utf8/page.html'])
+        self.assertIsInstance(report.errors['not_utf8/broken.html'], UnicodeDecodeError)
+
+    def test_preload_skips_pycache(self):
+        env = Environment(path_for_testing_dir)
+        report = env.preload('*', freeze=False)
+        self.assertIn('single_page.html', report.loaded)
+        self.assertFalse([name for name in report.loaded + list(report.errors) if '__pycache__' in name])
+
+    @unittest.skipUnless(hasattr(gc, 'freeze'), 'gc.freeze is not available')
+    def test_preload_freezes_gc(self):
+        self.addCleanup(gc.unfreeze)
+        report = Environment(path_for_testing_dir).preload(['single_page.html'])
+        self.assertEqual(report.loaded, ['single_page.html'])
+        self.assertGreater(gc.get_freeze_count(), 0)
+        self.assertGreater(report.memory, 0)
+
+    def test_preloaded_page_renders_as_collected(self):
+        env = Environment(path_for_testing_dir)
+        env.preload(['inheritance_and_include/base.html'], freeze=False)
+        rendered = env.render('inheritance_and_include/base.html')
+        expected = Collector(path_for_testing_dir, "/inheritance_and_include/base.html").assemble_page()
+        self.assertEqual(rendered, expected)
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(VariableTests))
     suite.addTest(unittest.makeSuite(ArrayTests))
     suite.addTest(unittest.makeSuite(IfTests))
     suite.addTest(unittest.makeSuite(CollectorTests))
+    suite.addTest(unittest.makeSuite(ErrorTests))
+    suite.addTest(unittest.makeSuite(EnvironmentTests))
     return suite
 
 if __name__ == '__main__':